@@ -2,15 +2,49 @@ from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from mangum import Mangum
 import fitz
-import tempfile
 import os
 import json
 import re
 import time
+import math
+import multiprocessing
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+from statistics import fmean
+import hashlib
+import tempfile
 
 app = FastAPI()
 
+# Vercel functions get a single vCPU, so a process pool only adds overhead there
+MAX_WORKERS = 1 if os.environ.get("VERCEL") else min(os.cpu_count() or 1, 4)
+# Handing a document to the pool costs a fixed ~20 ms (pickling the bytes and
+# re-opening the PDF in each worker), which short documents never win back.
+# Not yet measured on a multi-core host; override per deployment
+PARALLEL_MIN_PAGES = int(os.environ.get("PARALLEL_MIN_PAGES", 64))
+
+UPLOAD_CHUNK_SIZE = 1 << 20
+MAX_PDF_SIZE = 50 << 20
+
+# Results keyed by content hash, so re-uploads of the same PDF skip parsing.
+# On Vercel results are also written to /tmp, so a warm instance still finds
+# them after the in-memory LRU has evicted them. /tmp is size-limited, so the
+# directory is capped too, dropping the least recently used files first
+RESULT_CACHE_SIZE = 64
+RESULT_CACHE_FILES = 512
+RESULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "pdf-heading-cache") if os.environ.get("VERCEL") else None
+_result_cache = OrderedDict()
+
+# Default dict flags minus image blocks, which we never read
+TEXT_FLAGS = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+
+_WS_RE = re.compile(r'\s+')
+_NONWORD_RE = re.compile(r'\W+')
+# str.translate deletion table for every ASCII character \W matches
+_NONWORD_TABLE = dict.fromkeys(c for c in range(128) if _NONWORD_RE.match(chr(c)))
+
 # CORS - Allow your Vercel domain
 app.add_middleware(
     CORSMiddleware,
@@ -24,6 +58,21 @@ app.add_middleware(
 def extract_text_from_line(line):
     return "".join(span["text"] for span in line.get("spans", []))
 
+# One entry per line with spans, built once per page so the dominant span
+# and normalised text are not recomputed by each consumer
+LineInfo = namedtuple("LineInfo", "line text max_span bbox")
+
+def get_page_lines(blocks):
+    lines = []
+    for block in blocks:
+        for line in block.get("lines", []):
+            spans = line.get("spans")
+            if spans:
+                text = _WS_RE.sub(' ', extract_text_from_line(line)).strip()
+                max_span = max(spans, key=lambda s: s.get("size", 0))
+                lines.append(LineInfo(line, text, max_span, line["bbox"]))
+    return lines
+
 def get_font_features(span):
     return {
         "size": span.get("size", 0),
@@ -32,136 +81,78 @@ def get_font_features(span):
         "flags": span.get("flags", 0)
     }
 
+# Fonts repeat across nearly every span of a document, so memoise the name scan
+@lru_cache(maxsize=512)
 def is_bold(font_name):
     return any(weight in font_name for weight in ["bold", "semibold", "medium", "black"])
 
+# Expects lines sorted by top y, so the mean gap between consecutive lines
+# telescopes to (last_y - first_y) / (count - 1)
 def get_page_font_stats(lines):
-    sizes = []
-    y_positions = []
-    
-    for line in lines:
-        if line.get("spans"):
-            max_span = max(line["spans"], key=lambda s: s.get("size", 0))
-            sizes.append(max_span.get("size", 0))
-            y_positions.append(line["bbox"][1])
-    
-    if not sizes:
+    if not lines:
         return {"avg_font_size": 0, "std_font_size": 0, "avg_spacing": 0}
     
-    spacing = np.diff(sorted(y_positions)) if len(y_positions) > 1 else [0]
+    sizes = [info.max_span.get("size", 0) for info in lines]
+    count = len(sizes)
+    avg_size = fmean(sizes)
+    variance = fmean([(s - avg_size) * (s - avg_size) for s in sizes])
+    
     return {
-        "avg_font_size": np.mean(sizes) if sizes else 0,
-        "std_font_size": np.std(sizes) if sizes else 0,
-        "avg_spacing": np.mean(spacing) if len(spacing) > 0 else 0
+        "avg_font_size": avg_size,
+        "std_font_size": math.sqrt(variance),
+        "avg_spacing": (lines[-1].bbox[1] - lines[0].bbox[1]) / (count - 1) if count > 1 else 0
     }
 
-def is_likely_heading(line, prev_y, stats, page_width=595):
-    if not line.get("spans"):
+def is_heading_text(text):
+    if len(text) < 2 or len(text.split()) > 12:
         return False
     
-    spans = line["spans"]
-    text = extract_text_from_line(line).strip()
-    text = re.sub(r'\s+', ' ', text).strip()
-    
-    if not text or len(text.split()) > 12 or len(text) < 2:
-        return False
-    
-    if (text.endswith('.') or text.endswith(',') or text.endswith(':') or 
-        text.startswith('•') or text.isdigit()):
-        return False
+    return not (text.endswith(('.', ',', ':')) or text.startswith('•') or text.isdigit())
+
+# Character-class checks on text that already passed is_heading_text, so it
+# is never empty. map() keeps the digit count in C instead of a generator
+def _text_stats(text):
+    digit_frac = sum(map(str.isdigit, text)) / len(text)
+    return digit_frac, text.isupper(), text.istitle()
+
+# Numeric row consumed by score_lines:
+# (size, bold, x0, x1, y0, prev_y, caps_or_title, short)
+def line_features(info, prev_y):
+    text = info.text
+    if not is_heading_text(text):
+        return None
     
-    char_count = len(text)
-    digit_count = sum(1 for c in text if c.isdigit())
-    if char_count > 0 and digit_count / char_count > 0.3:
-        return False
+    digit_frac, is_upper, is_title = _text_stats(text)
+    if digit_frac > 0.3:
+        return None
     
-    span = max(spans, key=lambda s: s.get("size", 0))
-    font = get_font_features(span)
-    size = font["size"]
+    font = get_font_features(info.max_span)
     bold = is_bold(font["font"]) or bool(font["flags"] & 16)
-    caps = text.isupper()
-    title_case = text.istitle()
-    short = len(text) <= 50
-    
-    z_score = (size - stats["avg_font_size"]) / (stats["std_font_size"] + 1e-5) if stats["std_font_size"] else 0
-    
-    bbox = line["bbox"]
-    centered = abs((bbox[0] + bbox[2]) / 2 - page_width/2) < 50
-    whitespace_above = bbox[1] - prev_y if prev_y else 0
-    spacious = whitespace_above > stats["avg_spacing"] * 1.2 if stats["avg_spacing"] else False
-    
-    score = 0
-    score += 3 if z_score > 1.5 else (2 if z_score > 1.0 else 0)
-    score += 2 if bold else 0
-    score += 1.5 if centered else 0
-    score += 1.5 if spacious else 0
-    score += 1 if caps or title_case else 0
-    score += 1 if short else 0
-    
-    return score >= 6
+    bbox = info.bbox
+    return (font["size"], bold, bbox[0], bbox[2], bbox[1], prev_y or 0,
+            is_upper or is_title, len(text) <= 50)
 
-def extract_title(page):
-    title_candidates = []
-    blocks = page.get_text("dict")["blocks"]
-    all_lines = []
-    
-    for block in blocks:
-        for line in block.get("lines", []):
-            all_lines.append(line)
-    
-    if not all_lines:
-        return ""
+# Scores a whole page of feature rows at once with numpy, keeping the
+# per-line Python work to the text handling in line_features
+def score_lines(rows, stats, page_width=595):
+    if not rows:
+        return []
     
-    stats = get_page_font_stats(all_lines)
-    prev_y = None
+    size, bold, x0, x1, y0, prev_y, cased, short = np.array(rows, dtype=np.float64).T
+    avg_spacing = stats["avg_spacing"]
     
-    for block in blocks:
-        for line in block.get("lines", []):
-            spans = line["spans"]
-            if not spans:
-                continue
-            
-            line_text = extract_text_from_line(line)
-            line_text = re.sub(r'\s+', ' ', line_text).strip()
-            
-            if len(line_text.split()) > 6 or len(line_text) < 3:
-                continue
-            
-            if is_likely_heading(line, prev_y, stats, page.rect.width):
-                span = max(spans, key=lambda s: s["size"])
-                title_candidates.append({
-                    "text": line_text,
-                    "size": span["size"],
-                    "bold": bool(span["flags"] & 16),
-                    "position": line["bbox"][1] / page.rect.height,
-                    "bbox": line["bbox"]
-                })
-            
-            prev_y = line["bbox"][3]
-    
-    if not title_candidates:
-        largest_text = ""
-        max_size = 0
-        for block in blocks:
-            for line in block.get("lines", []):
-                if line.get("spans"):
-                    span = max(line["spans"], key=lambda s: s["size"])
-                    if span["size"] > max_size:
-                        max_size = span["size"]
-                        largest_text = extract_text_from_line(line)
-        return largest_text.strip()
+    if stats["std_font_size"]:
+        z_score = (size - stats["avg_font_size"]) / (stats["std_font_size"] + 1e-5)
+    else:
+        z_score = np.zeros_like(size)
+    centered = np.abs((x0 + x1) / 2 - page_width/2) < 50
+    whitespace_above = np.where(prev_y != 0, y0 - prev_y, 0)
+    spacious = whitespace_above > avg_spacing * 1.2 if avg_spacing else np.zeros_like(centered)
     
-    max_size = max(c["size"] for c in title_candidates)
-    for c in title_candidates:
-        c["score"] = (
-            (c["size"] / max_size) * 3 +
-            (1.5 if c["bold"] else 0) +
-            (2 if 0 <= c["position"] < 0.3 else 0) +
-            (1.5 if c["text"].istitle() or c["text"].isupper() else 0)
-        )
+    score = np.where(z_score > 1.5, 3, np.where(z_score > 1.0, 2, 0))
+    score = score + 2 * bold + 1.5 * centered + 1.5 * spacious + cased + short
     
-    best_title = max(title_candidates, key=lambda x: x["score"])
-    return best_title["text"]
+    return (score >= 6).tolist()
 
 def cluster_font_sizes(candidates):
     if not candidates:
@@ -188,61 +179,108 @@ def cluster_font_sizes(candidates):
     sorted_candidates = sorted(candidates, key=lambda x: (x["page"], x["bbox"][1]))
     return level_map, sorted_candidates
 
-def extract_headings(doc):
+# Picks the title from page 0's already-scored heading lines rather than
+# running a second pass over the page
+def pick_title(page, lines, scored):
+    title_candidates = [(info, row) for info, row in scored
+                        if len(info.text) >= 3 and len(info.text.split()) <= 6]
+    
+    if not title_candidates:
+        largest_text = ""
+        max_size = 0
+        for info in lines:
+            if info.max_span["size"] > max_size:
+                max_size = info.max_span["size"]
+                largest_text = extract_text_from_line(info.line)
+        return largest_text.strip()
+    
+    max_size = max(row[0] for _, row in title_candidates)
+    page_height = page.rect.height
+    best_title = ""
+    best_score = None
+    
+    for info, row in title_candidates:
+        position = info.bbox[1] / page_height
+        score = (
+            (row[0] / max_size) * 3 +
+            (1.5 if info.max_span["flags"] & 16 else 0) +
+            (2 if 0 <= position < 0.3 else 0) +
+            (1.5 if row[6] else 0)
+        )
+        if best_score is None or score > best_score:
+            best_title = info.text
+            best_score = score
+    
+    return best_title
+
+def extract_page_headings(page, page_num, seen_headings):
     headings = []
     title = ""
-    seen_headings = set()
     
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        blocks = page.get_text("dict")["blocks"]
-        all_lines = []
+    # Build the text page once: a plain-text probe on it finds scanned or
+    # image-only pages without constructing the dict, and the dict reuses it
+    textpage = page.get_textpage(flags=TEXT_FLAGS)
+    if not textpage.extractText().strip():
+        return headings, title
+    
+    blocks = [b for b in page.get_text("dict", textpage=textpage)["blocks"] if b.get("type") == 0]
+    lines = get_page_lines(blocks)
+    
+    if not lines:
+        return headings, title
+    
+    lines.sort(key=lambda info: info.bbox[1])
+    stats = get_page_font_stats(lines)
+    candidates = []
+    rows = []
+    prev_y = None
+    
+    for info in lines:
+        if not info.text:
+            continue
         
-        for block in blocks:
-            for line in block.get("lines", []):
-                all_lines.append(line)
+        row = line_features(info, prev_y)
+        if row:
+            candidates.append(info)
+            rows.append(row)
         
-        if not all_lines:
+        prev_y = info.bbox[3]
+    
+    scored = [(info, row) for info, row, is_heading
+              in zip(candidates, rows, score_lines(rows, stats, page.rect.width)) if is_heading]
+    
+    if page_num == 0:
+        title = pick_title(page, lines, scored)
+    
+    for info, row in scored:
+        if page_num == 0 and info.text.lower() == title.lower():
             continue
         
-        stats = get_page_font_stats(all_lines)
-        all_lines.sort(key=lambda line: line["bbox"][1])
-        prev_y = None
-        
-        if page_num == 0:
-            title = extract_title(page)
+        key = heading_key(info.text)
+        if key in seen_headings:
+            continue
+        seen_headings.add(key)
         
-        for line in all_lines:
-            spans = line.get("spans", [])
-            if not spans:
-                continue
-            
-            line_text = extract_text_from_line(line)
-            line_text = re.sub(r'\s+', ' ', line_text).strip()
-            if not line_text:
-                continue
-            
-            if page_num == 0 and line_text.lower() == title.lower():
-                continue
-            
-            if is_likely_heading(line, prev_y, stats, page.rect.width):
-                font_size = max(span["size"] for span in spans)
-                bbox = line["bbox"]
-                
-                norm_text = re.sub(r'\W+', '', line_text).lower()
-                if norm_text in seen_headings:
-                    continue
-                seen_headings.add(norm_text)
-                
-                headings.append({
-                    "text": line_text,
-                    "size": font_size,
-                    "page": page_num,
-                    "bbox": bbox
-                })
-            
-            prev_y = line["bbox"][3]
+        headings.append({
+            "text": info.text,
+            "size": row[0],
+            "page": page_num,
+            "bbox": info.bbox
+        })
     
+    return headings, title
+
+# Dedup sets hold the hash of the normalised text rather than the string
+# itself. str hashes are salted per process, which is fine because every
+# seen-set is built and checked within a single process
+def heading_key(text):
+    key = text.translate(_NONWORD_TABLE)
+    # The table only covers ASCII; let the regex handle anything it missed
+    if not key.isascii():
+        key = _NONWORD_RE.sub('', key)
+    return hash(key.lower())
+
+def build_outline(headings):
     level_map, sorted_headings = cluster_font_sizes(headings)
     
     outline = []
@@ -255,7 +293,134 @@ def extract_headings(doc):
                 "page": h["page"] + 1
             })
     
-    return title, outline
+    return outline
+
+def extract_headings(doc):
+    headings = []
+    title = ""
+    seen_headings = set()
+    
+    for page_num in range(len(doc)):
+        page = doc.load_page(page_num)
+        page_headings, page_title = extract_page_headings(page, page_num, seen_headings)
+        headings.extend(page_headings)
+        if page_num == 0:
+            title = page_title
+    
+    return title, build_outline(headings)
+
+# One pool for the life of the server, created on first use. Workers are
+# spawned rather than forked: Starlette may already be running threadpool
+# threads when the pool starts, and forking a threaded process can deadlock
+_executor = None
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=MAX_WORKERS,
+                                        mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+@app.on_event("shutdown")
+def shutdown_executor():
+    if _executor is not None:
+        _executor.shutdown()
+
+# Runs in a worker: opens the PDF once for a contiguous run of pages
+def _process_pages(content, page_nums):
+    doc = fitz.open(stream=content, filetype="pdf")
+    try:
+        return [extract_page_headings(doc.load_page(page_num), page_num, set())
+                for page_num in page_nums]
+    finally:
+        doc.close()
+
+def extract_headings_parallel(content, page_count):
+    headings = []
+    title = ""
+    seen_headings = set()
+    
+    chunk_size = -(-page_count // MAX_WORKERS)
+    chunks = [range(start, min(start + chunk_size, page_count))
+              for start in range(0, page_count, chunk_size)]
+    futures = [get_executor().submit(_process_pages, content, chunk) for chunk in chunks]
+    
+    # Workers only dedupe within their own page, so repeat the check across pages
+    page_num = 0
+    for future in futures:
+        for page_headings, page_title in future.result():
+            if page_num == 0:
+                title = page_title
+            for h in page_headings:
+                key = heading_key(h["text"])
+                if key in seen_headings:
+                    continue
+                seen_headings.add(key)
+                headings.append(h)
+            page_num += 1
+    
+    return title, build_outline(headings)
+
+def content_hash(content):
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+def get_cached_result(key):
+    if key in _result_cache:
+        _result_cache.move_to_end(key)
+        return _result_cache[key]
+    
+    if not RESULT_CACHE_DIR:
+        return None
+    
+    path = os.path.join(RESULT_CACHE_DIR, f"{key}.json")
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+        # mtime doubles as last-use time for prune_cache_dir
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    
+    result = (cached["title"], cached["outline"])
+    remember_result(key, result, persist=False)
+    return result
+
+def remember_result(key, result, persist=True):
+    _result_cache[key] = result
+    _result_cache.move_to_end(key)
+    if len(_result_cache) > RESULT_CACHE_SIZE:
+        _result_cache.popitem(last=False)
+    
+    if persist and RESULT_CACHE_DIR:
+        try:
+            os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+            path = os.path.join(RESULT_CACHE_DIR, f"{key}.json")
+            with open(f"{path}.tmp", "w") as f:
+                json.dump({"title": result[0], "outline": result[1]}, f)
+            os.replace(f"{path}.tmp", path)
+            prune_cache_dir()
+        except OSError:
+            pass
+
+def prune_cache_dir():
+    entries = []
+    with os.scandir(RESULT_CACHE_DIR) as it:
+        for entry in it:
+            if entry.name.endswith(".json"):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except OSError:
+                    continue
+    
+    if len(entries) <= RESULT_CACHE_FILES:
+        return
+    
+    entries.sort()
+    for _, path in entries[:len(entries) - RESULT_CACHE_FILES]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
 @app.get("/")
 def read_root():
@@ -270,18 +435,29 @@ async def extract_headings_api(file: UploadFile = File(...)):
     if not file.filename.endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
     
+    content = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        content += chunk
+        if len(content) > MAX_PDF_SIZE:
+            raise HTTPException(status_code=413, detail="PDF exceeds the maximum upload size")
+    
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-            content = await file.read()
-            tmp_file.write(content)
-            tmp_path = tmp_file.name
-        
         start_time = time.time()
-        doc = fitz.open(tmp_path)
-        title, outline = extract_headings(doc)
-        doc.close()
+        key = content_hash(content)
+        cached = get_cached_result(key)
         
-        os.unlink(tmp_path)
+        if cached:
+            title, outline = cached
+        else:
+            doc = fitz.open(stream=content, filetype="pdf")
+            page_count = len(doc)
+            if MAX_WORKERS > 1 and page_count >= PARALLEL_MIN_PAGES:
+                doc.close()
+                title, outline = extract_headings_parallel(content, page_count)
+            else:
+                title, outline = extract_headings(doc)
+                doc.close()
+            remember_result(key, (title, outline))
         
         processing_time = time.time() - start_time
         